@@ -81,6 +81,28 @@
 #endif
 
 
+/*
+ * To mark functions that are rarely called, like error paths, lets the
+ * compiler move them out of the way of the hot code.
+ */
+#if defined(__GNUC__)
+#define XRT_COLD __attribute__((cold))
+#else
+#define XRT_COLD
+#endif
+
+
+/*
+ * To hint that a condition is almost never true, like a validation check,
+ * so the compiler lays out the other path as the fall-through.
+ */
+#if defined(__GNUC__)
+#define XRT_UNLIKELY(x) __builtin_expect(!!(x), 0)
+#else
+#define XRT_UNLIKELY(x) (x)
+#endif
+
+
 #ifdef XRT_DOXYGEN
 /*!
  * To trigger a trap/break in the debugger.
@@ -32,6 +32,9 @@ ipc_client_connection_init(struct ipc_connection *ipc_c,
 /*!
  * Locks the connection, allows sending complex messages.
  *
+ * Also lets several calls be made with one lock, using the generated
+ * `ipc_call_*_locked` functions instead of the plain `ipc_call_*` ones.
+ *
  * @param ipc_c The IPC connection to lock.
  *
  * @ingroup ipc_client
@@ -15,6 +15,8 @@
 #include "server/ipc_server.h"
 #include "ipc_server_generated.h"
 
+#include <stddef.h>
+
 #ifndef XRT_OS_WINDOWS
 
 #include <unistd.h>
@@ -29,6 +31,23 @@
 #endif // XRT_OS_WINDOWS
 
 
+/*
+ *
+ * Structs.
+ *
+ */
+
+/*!
+ * Buffer a single message is received into, the generated msg structs are
+ * naturally aligned and are read in place by the dispatch functions.
+ */
+union ipc_msg_buf
+{
+	uint8_t buf[IPC_BUF_SIZE];
+	max_align_t align;
+};
+
+
 /*
  *
  * Helper functions.
@@ -176,16 +195,16 @@ client_loop(volatile struct ipc_client_state *ics)
 		}
 
 		// Read the whole command now that we know its size
-		uint8_t buf[IPC_BUF_SIZE] = {0};
+		union ipc_msg_buf msg_buf = {0};
 
-		len = recv(ics->imc.ipc_handle, &buf, cmd_size, 0);
+		len = recv(ics->imc.ipc_handle, msg_buf.buf, cmd_size, 0);
 		if (len != (ssize_t)cmd_size) {
 			IPC_ERROR(ics->server, "Invalid packet received, disconnecting client.");
 			break;
 		}
 
 		// Check the first 4 bytes of the message and dispatch.
-		ipc_command_t *ipc_command = (ipc_command_t *)buf;
+		ipc_command_t *ipc_command = (ipc_command_t *)msg_buf.buf;
 
 		IPC_TRACE_BEGIN(ipc_dispatch);
 		xrt_result_t result = ipc_dispatch(ics, ipc_command);
@@ -226,7 +245,7 @@ client_loop(volatile struct ipc_client_state *ics)
 	IPC_INFO(ics->server, "Client connected");
 
 	while (ics->server->running) {
-		uint8_t buf[IPC_BUF_SIZE] = {0};
+		union ipc_msg_buf msg_buf = {0};
 		DWORD len = 0;
 		BOOL bret = false;
 
@@ -238,7 +257,7 @@ client_loop(volatile struct ipc_client_state *ics)
 		 * to the command size, this is what we get here, variable
 		 * length data is read in the dispatch function for the command.
 		 */
-		bret = ReadFile(ics->imc.ipc_handle, buf, sizeof(buf), &len, NULL);
+		bret = ReadFile(ics->imc.ipc_handle, msg_buf.buf, sizeof(msg_buf.buf), &len, NULL);
 		if (!bret) {
 			pipe_print_get_last_error(ics, "ReadFile");
 			IPC_ERROR(ics->server, "ReadFile failed, disconnecting client.");
@@ -252,7 +271,7 @@ client_loop(volatile struct ipc_client_state *ics)
 		}
 
 		// Now safe to cast into a command pointer, used for dispatch.
-		ipc_command_t *cmd_ptr = (ipc_command_t *)buf;
+		ipc_command_t *cmd_ptr = (ipc_command_t *)msg_buf.buf;
 
 		// Read the command, we know we have at least 4 bytes.
 		ipc_command_t cmd = *cmd_ptr;
@@ -65,38 +65,56 @@ def write_result_handler(f, result, cleanup="", indent=""):
 
 
 def write_msg_struct(f, call, ident):
-    # Message struct
+    # Message struct, zeroed so no padding bytes from the stack are sent,
+    # built up and written in one go.
     if call.needs_msg_struct:
-        f.write(ident + "struct ipc_" + call.name + "_msg _msg = {\n")
+        lines = [ident + call.msg_struct + " _msg;\n"]
     else:
-        f.write(ident + "struct ipc_command_msg _msg = {\n")
+        lines = [ident + "struct ipc_command_msg _msg;\n"]
 
-    f.write(ident + "    .cmd = " + str(call.id) + ",\n")
+    lines.append(ident + "U_ZERO(&_msg);\n")
+    lines.append(ident + "_msg.cmd = " + str(call.id) + ";\n")
     for arg in call.in_args:
         if arg.is_aggregate:
-            f.write(ident + "    ." + arg.name + " = *" + arg.name + ",\n")
+            lines.append(ident + "_msg." + arg.name + " = *" + arg.name + ";\n")
         else:
-            f.write(ident + "    ." + arg.name + " = " + arg.name + ",\n")
+            lines.append(ident + "_msg." + arg.name + " = " + arg.name + ";\n")
     if call.in_handles:
-        f.write(ident + "    ." + call.in_handles.count_arg_name + " = " +
-                call.in_handles.count_arg_name + ",\n")
-    f.write(ident + "};\n")
+        lines.append(ident + "_msg." + call.in_handles.count_arg_name + " = " +
+                     call.in_handles.count_arg_name + ";\n")
+    f.write("".join(lines))
+
+
+def known_field_offsets(fields):
+    """Get (arg, offset) for struct fields laid out after a 4 byte field.
+
+    Stops at the first aggregate, the offsets after it are not known.
+    """
+    offset = 4
+    for arg in fields:
+        if arg.is_aggregate:
+            return
+        offset = -(-offset // arg.alignof) * arg.alignof
+        yield arg, offset
+        offset += arg.alignof
 
 
 def write_reply_struct(f, call, ident):
     # Reply struct
     if call.out_args:
-        f.write(ident + "struct ipc_" + call.name + "_reply _reply;\n")
+        f.write(ident + call.reply_struct + " _reply;\n")
     else:
         f.write(ident + "struct ipc_result_reply _reply = {0};\n")
-    if call.in_handles:
-        f.write(ident + "struct ipc_result_reply _sync = {0};\n")
 
 
-def write_msg_send(f, ret, indent):
+def write_msg_send(f, call, ret, indent):
     # Prepare initial sending
     func = 'ipc_send'
-    args = ['&ipc_c->imc', '&_msg', 'sizeof(_msg)']
+    if call.needs_msg_struct:
+        size = call.msg_size
+    else:
+        size = 'sizeof(_msg)'
+    args = ['&ipc_c->imc', '&_msg', size]
 
     f.write("\n" + indent + "// Send our request")
     write_invocation(f, ret, func, args, indent=indent)
@@ -107,14 +125,18 @@ class Arg:
     """An IPC call argument."""
 
     # Keep all these synchronized with the definitions in the JSON Schema.
-    SCALAR_TYPES = set(("uint32_t",
-                        "int64_t",
-                        "uint64_t",
-                        "bool",
-                        "float"))
+    # Scalar types map to their size, which is also their alignment.
+    SCALAR_TYPES = {"uint32_t": 4,
+                    "int64_t": 8,
+                    "uint64_t": 8,
+                    "bool": 1,
+                    "float": 4}
     AGGREGATE_RE = re.compile(r"((const )?struct|union) (xrt|ipc)_[a-z_]+")
     ENUM_RE = re.compile(r"enum xrt_[a-z_]+")
 
+    # Enums are assumed to be the size of an int.
+    ENUM_ALIGNMENT = 4
+
     @classmethod
     def parse_array(cls, a):
         """Turn an array of data into an array of Arg objects."""
@@ -148,10 +170,14 @@ class Arg:
         self.is_enum = False
         if self.typename in self.SCALAR_TYPES:
             self.is_standard_scalar = True
+            self.alignof = self.SCALAR_TYPES[self.typename]
         elif self.AGGREGATE_RE.match(self.typename):
             self.is_aggregate = True
+            # Not known here, anywhere from 1 to 8.
+            self.alignof = None
         elif self.ENUM_RE.match(self.typename):
             self.is_enum = True
+            self.alignof = self.ENUM_ALIGNMENT
         else:
             raise RuntimeError("Could not process type name: " + self.typename)
 
@@ -192,6 +218,11 @@ class HandleType:
         """Get the type of the count argument."""
         return "uint32_t"
 
+    @property
+    def count_arg(self):
+        """Get the count argument as an Arg, used for the msg struct field."""
+        return Arg({'name': self.count_arg_name, 'type': self.count_arg_type})
+
     @property
     def arg_names(self):
         """Get the argument names for the client proxy."""
@@ -253,8 +284,9 @@ class Call:
         args.extend(arg.get_func_argument_out() for arg in self.out_args)
         write_decl(f, 'xrt_result_t', 'ipc_receive_' + self.name + "_locked", args)
 
-    def write_call_decl(self, f):
-        """Write declaration of ipc_call_CALLNAME."""
+    @property
+    def call_arg_decls(self):
+        """Get the argument declarations for ipc_call_CALLNAME."""
         args = ["struct ipc_connection *ipc_c"]
         args.extend(arg.get_func_argument_in() for arg in self.in_args)
         if self.in_handles:
@@ -262,7 +294,29 @@ class Call:
         args.extend(arg.get_func_argument_out() for arg in self.out_args)
         if self.out_handles:
             args.extend(self.out_handles.arg_decls)
-        write_decl(f, 'xrt_result_t', 'ipc_call_' + self.name, args)
+        return args
+
+    @property
+    def call_arg_names(self):
+        """Get the argument names for ipc_call_CALLNAME."""
+        args = ["ipc_c"]
+        args.extend(arg.name for arg in self.in_args)
+        if self.in_handles:
+            args.extend(self.in_handles.arg_names)
+        args.extend("out_" + arg.name for arg in self.out_args)
+        if self.out_handles:
+            args.extend(self.out_handles.arg_names)
+        return args
+
+    def write_call_decl(self, f):
+        """Write declaration of ipc_call_CALLNAME."""
+        write_decl(f, 'xrt_result_t', 'ipc_call_' + self.name,
+                   self.call_arg_decls)
+
+    def write_call_locked_decl(self, f):
+        """Write declaration of ipc_call_CALLNAME_locked."""
+        write_decl(f, 'xrt_result_t', 'ipc_call_' + self.name + "_locked",
+                   self.call_arg_decls)
 
     def write_handler_decl(self, f):
         """Write declaration of ipc_handle_CALLNAME."""
@@ -282,6 +336,48 @@ class Call:
 
         write_decl(f, 'xrt_result_t', 'ipc_handle_' + self.name, args)
 
+    @staticmethod
+    def sorted_for_layout(args):
+        """Get args ordered to avoid padding after the leading 4 byte field.
+
+        The slot after the cmd/result field is filled with narrow scalars,
+        then come the 8 byte scalars and the aggregates, whose alignment is
+        not known here, and last the remaining narrow scalars.
+        """
+        scalars = sorted((arg for arg in args if not arg.is_aggregate),
+                         key=lambda arg: -arg.alignof)
+        aggregates = [arg for arg in args if arg.is_aggregate]
+
+        fill = []
+        space = 4
+        for arg in scalars:
+            if arg.alignof <= space:
+                fill.append(arg)
+                space -= arg.alignof
+
+        rest = [arg for arg in scalars if arg not in fill]
+        wide = [arg for arg in rest if arg.alignof == 8]
+        narrow = [arg for arg in rest if arg.alignof < 8]
+
+        # With the slot still empty a 4 byte aligned aggregate may fit in it.
+        if fill:
+            return fill + wide + aggregates + narrow
+        else:
+            return aggregates + wide + narrow
+
+    @property
+    def msg_struct_fields(self):
+        """Get the msg struct fields after cmd, in layout order."""
+        args = list(self.in_args)
+        if self.in_handles:
+            args.append(self.in_handles.count_arg)
+        return self.sorted_for_layout(args)
+
+    @property
+    def reply_struct_fields(self):
+        """Get the reply struct fields after result, in layout order."""
+        return self.sorted_for_layout(self.out_args)
+
     @property
     def needs_msg_struct(self):
         """Decide whether this call needs a msg struct."""
@@ -313,6 +409,10 @@ class Call:
                 raise RuntimeError("Unrecognized key")
         if not self.id:
             self.id = "IPC_" + name.upper()
+        # Used by every generated file, so only build them once.
+        self.msg_struct = "struct ipc_" + name + "_msg"
+        self.msg_size = "IPC_MSG_SIZE_" + name.upper()
+        self.reply_struct = "struct ipc_" + name + "_reply"
         if self.varlen and (self.in_handles or self.out_handles):
             raise Exception("Can not have handles with varlen functions")
 
@@ -341,3 +441,8 @@ class Proto:
         self.calls = [Call(name, call) for name, call
                       in data.items()
                       if not name.startswith("$")]
+        # Calls that get a struct in the protocol header.
+        self.msg_struct_calls = [call for call in self.calls
+                                 if call.needs_msg_struct]
+        self.reply_struct_calls = [call for call in self.calls
+                                   if call.out_args]
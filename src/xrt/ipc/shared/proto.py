@@ -3,12 +3,13 @@
 # SPDX-License-Identifier: BSL-1.0
 """Generate code from a JSON file describing the IPC protocol."""
 
-import argparse
+import io
 
 from ipcproto.common import (Proto, write_decl, write_invocation,
                              write_result_handler, write_cpp_header_guard_start,
                              write_cpp_header_guard_end, write_msg_struct,
-                             write_reply_struct, write_msg_send)
+                             write_reply_struct, write_msg_send,
+                             known_field_offsets)
 
 header = '''// Copyright 2020-2023, Collabora, Ltd.
 // SPDX-License-Identifier: BSL-1.0
@@ -20,6 +21,230 @@ header = '''// Copyright 2020-2023, Collabora, Ltd.
  */
 '''
 
+HEADER_PLAIN = header.format(brief='Generated IPC protocol header', suffix='')
+HEADER_CLIENT = header.format(brief='Generated IPC client code',
+                              suffix='_client')
+HEADER_SERVER = header.format(brief='Generated IPC server code',
+                              suffix='_server')
+
+# What comes after the header in each generated file.
+PROTOCOL_H_PREAMBLE = '''
+#pragma once
+
+#include "xrt/xrt_compiler.h"
+
+'''
+
+CLIENT_C_PREAMBLE = '''
+#include "util/u_misc.h"
+
+#include "client/ipc_client.h"
+#include "ipc_protocol_generated.h"
+
+
+\n'''
+
+CLIENT_H_PREAMBLE = '''
+#pragma once
+
+#include "shared/ipc_protocol.h"
+#include "ipc_protocol_generated.h"
+#include "client/ipc_client.h"
+
+'''
+
+SERVER_C_PREAMBLE = '''
+#include "xrt/xrt_limits.h"
+
+#include "shared/ipc_protocol.h"
+#include "shared/ipc_utils.h"
+
+#include "server/ipc_server.h"
+
+#include "ipc_server_generated.h"
+
+#include <assert.h>
+#include <stddef.h>
+
+'''
+
+SERVER_H_PREAMBLE = '''
+#pragma once
+
+#include "shared/ipc_protocol.h"
+#include "ipc_protocol_generated.h"
+#include "server/ipc_server.h"
+
+
+'''
+
+# Boilerplate for the generated files, the {placeholders} are filled in with
+# the per-call lines when rendering.
+COMMAND_ENUM_TEMPLATE = '''
+typedef enum ipc_command
+{{
+\tIPC_ERR = 0,{entries}
+}} ipc_command_t;
+
+#define IPC_COMMAND__COUNT {count}
+'''
+
+CMD_TO_STR_BODY_TEMPLATE = '''
+{{
+\t// Same order as enum ipc_command, so it can be indexed by the command.
+\tstatic const char *const names[IPC_COMMAND__COUNT] = {{
+\t    "IPC_ERR",{names}
+\t}};
+
+\treturn (unsigned)id < IPC_COMMAND__COUNT ? names[id] : "IPC_UNKNOWN";
+}}
+'''
+
+MSG_STRUCT_TEMPLATE = '''
+{struct}
+{{
+\tenum ipc_command cmd;
+{fields}}};
+
+enum {{ {size} = sizeof({struct}) }};
+'''
+
+REPLY_STRUCT_TEMPLATE = '''
+{struct}
+{{
+\txrt_result_t result;
+{fields}}};
+'''
+
+# Error paths of the dispatch, kept out of line.
+DISPATCH_COLD_HELPERS = '''
+static XRT_COLD XRT_NO_INLINE xrt_result_t
+ipc_dispatch_bad_cmd(ipc_command_t cmd)
+{
+\tU_LOG_E("UNHANDLED IPC MESSAGE! %d", cmd);
+\treturn XRT_ERROR_IPC_FAILURE;
+}
+
+static XRT_COLD XRT_NO_INLINE xrt_result_t
+ipc_dispatch_bad_handle_count(ipc_command_t cmd, uint32_t handle_count)
+{
+\tU_LOG_E("Too many handles for %s: %u (max %d)", ipc_cmd_to_str(cmd), handle_count, XRT_MAX_IPC_HANDLES);
+\treturn XRT_ERROR_IPC_FAILURE;
+}
+'''
+
+DISPATCH_DEFINITION_START = '''
+static xrt_result_t
+ipc_dispatch_{name}(volatile struct ipc_client_state *ics, ipc_command_t *ipc_command)
+{{
+\tIPC_TRACE(ics->server, "Dispatching {name}");
+
+'''
+
+DISPATCH_TEMPLATE = '''
+typedef xrt_result_t (*ipc_dispatch_func_t)(volatile struct ipc_client_state *ics, ipc_command_t *ipc_command);
+
+// Indexed by command, IPC_ERR is left as NULL.
+static const ipc_dispatch_func_t ipc_dispatch_table[IPC_COMMAND__COUNT] = {{
+{entries}}};
+
+xrt_result_t
+ipc_dispatch(volatile struct ipc_client_state *ics, ipc_command_t *ipc_command)
+{{
+\tipc_command_t cmd = *ipc_command;
+\tif (XRT_UNLIKELY((unsigned)cmd >= IPC_COMMAND__COUNT || ipc_dispatch_table[cmd] == NULL)) {{
+\t\treturn ipc_dispatch_bad_cmd(cmd);
+\t}}
+
+\treturn ipc_dispatch_table[cmd](ics, ipc_command);
+}}
+
+'''
+
+COMMAND_SIZE_TEMPLATE = '''
+// The client loop reads each message into a IPC_BUF_SIZE sized buffer.
+{asserts}
+// Wire layout of the fields that the generator knows the offset of.
+{offsets}
+static const size_t ipc_command_sizes[IPC_COMMAND__COUNT] = {{
+{sizes}}};
+
+size_t
+ipc_command_size(const enum ipc_command cmd)
+{{
+\t// IPC_ERR is left as zero in the table, same as out of range commands.
+\tsize_t size = (unsigned)cmd < IPC_COMMAND__COUNT ? ipc_command_sizes[cmd] : 0;
+\tif (size == 0) {{
+\t\tU_LOG_E("UNHANDLED IPC COMMAND! %d", cmd);
+\t}}
+
+\treturn size;
+}}
+
+'''
+
+RECEIVE_DEFINITION_TEMPLATE = '''{decl}
+{{
+\tIPC_TRACE(ipc_c, "Receiving {name}");
+
+{reply_struct}
+\t// Await the reply{receive}{out_copy}
+\treturn _reply.result;
+}}
+'''
+
+CALL_LOCKED_DEFINITION_TEMPLATE = '''{decl}
+{{
+\tIPC_TRACE(ipc_c, "Calling {name}");
+
+{msg_struct}{reply_struct}{send}{handles}
+\t// Await the reply{receive}{out_copy}
+\treturn _reply.result;
+}}
+'''
+
+CALL_DEFINITION_TEMPLATE = '''{decl}
+{{
+\t// Other threads must not read/write the fd while we wait for reply
+\tos_mutex_lock(&ipc_c->mutex);{call};
+\tos_mutex_unlock(&ipc_c->mutex);
+
+\treturn ret;
+}}
+'''
+
+
+def write_output(file, f):
+    """Write everything buffered in f to file with a single write.
+
+    The file is left untouched if it already has the same contents, keeping
+    its timestamp so the build does not recompile everything including it.
+    The contents are encoded once here and handled as bytes from then on.
+    """
+    contents = f.getvalue().encode("utf-8")
+    try:
+        with open(file, "rb") as existing:
+            if existing.read() == contents:
+                return
+    except FileNotFoundError:
+        pass
+
+    with open(file, "wb") as out:
+        out.write(contents)
+
+
+def to_str(writer, *args):
+    """Call a write_* style function and return what it wrote as a string."""
+    f = io.StringIO()
+    writer(f, *args)
+    return f.getvalue()
+
+
+def out_args_copy_str(call):
+    """Get the lines copying the reply fields to the out arguments."""
+    return "".join("\t*out_" + arg.name + " = _reply." + arg.name + ";\n"
+                   for arg in call.out_args)
+
 
 def write_send_definition(f, call):
     """Write a ipc_send_CALLNAME_locked function."""
@@ -29,106 +254,95 @@ def write_send_definition(f, call):
 
     write_msg_struct(f, call, '\t')
 
-    write_msg_send(f, 'xrt_result_t ret', indent="\t")
+    write_msg_send(f, call, 'xrt_result_t ret', indent="\t")
 
     f.write("\n\treturn ret;\n}\n")
 
 
 def write_receive_definition(f, call):
     """Write a ipc_receive_CALLNAME_locked function."""
-    call.write_receive_decl(f)
-    f.write("\n{\n")
-    f.write("\tIPC_TRACE(ipc_c, \"Receiving " + call.name + "\");\n\n")
-
-    write_reply_struct(f, call, '\t')
-
-    f.write("\n\t// Await the reply")
+    receive = io.StringIO()
     func = 'ipc_receive'
     args = ['&ipc_c->imc', '&_reply', 'sizeof(_reply)']
-    write_invocation(f, 'xrt_result_t ret', func, args, indent="\t")
-    f.write(";")
-    write_result_handler(f, 'ret', None, indent="\t")
-
-    for arg in call.out_args:
-        f.write("\t*out_" + arg.name + " = _reply." + arg.name + ";\n")
+    write_invocation(receive, 'xrt_result_t ret', func, args, indent="\t")
+    receive.write(";")
+    write_result_handler(receive, 'ret', None, indent="\t")
 
-    f.write("\n\treturn _reply.result;\n}\n")
+    f.write(RECEIVE_DEFINITION_TEMPLATE.format(
+        decl=to_str(call.write_receive_decl),
+        name=call.name,
+        reply_struct=to_str(write_reply_struct, call, '\t'),
+        receive=receive.getvalue(),
+        out_copy=out_args_copy_str(call)))
 
 
-def write_call_definition(f, call):
-    """Write a ipc_call_CALLNAME function."""
-    call.write_call_decl(f)
-    f.write("\n{\n")
-
-    f.write("\tIPC_TRACE(ipc_c, \"Calling " + call.name + "\");\n\n")
-
-    write_msg_struct(f, call, '\t')
-    write_reply_struct(f, call, '\t')
-
-    f.write("""
-\t// Other threads must not read/write the fd while we wait for reply
-\tos_mutex_lock(&ipc_c->mutex);
-""")
-    cleanup = "os_mutex_unlock(&ipc_c->mutex);"
+def write_call_locked_definition(f, call):
+    """Write a ipc_call_CALLNAME_locked function."""
+    cleanup = None
+    in_handles = call.in_handles
+    out_handles = call.out_handles
 
     # Prepare initial sending
-    write_msg_send(f, 'xrt_result_t ret', indent="\t")
-    write_result_handler(f, 'ret', cleanup, indent="\t")
+    send = io.StringIO()
+    write_msg_send(send, call, 'xrt_result_t ret', indent="\t")
+    write_result_handler(send, 'ret', cleanup, indent="\t")
 
-    if call.in_handles:
-        f.write("\n\t// Send our handles separately\n")
-        f.write("\n\t// Wait for server sync")
-        # Must sync with the server so it's expecting the next message.
-        write_invocation(
-            f,
-            'ret',
-            'ipc_receive',
-            (
-                '&ipc_c->imc',
-                '&_sync',
-                'sizeof(_sync)'
-                ),
-            indent="\t"
-        )
-        f.write(';')
-        write_result_handler(f, 'ret', cleanup, indent="\t")
+    handles = io.StringIO()
+    if in_handles:
+        handles.write("\n\t// Send our handles separately\n")
 
         # Must send these in a second message
         # since the server doesn't know how many to expect.
-        f.write("\n\t// We need this message data as filler only\n")
-        f.write("\tstruct ipc_command_msg _handle_msg = {\n")
-        f.write("\t    .cmd = " + str(call.id) + ",\n")
-        f.write("\t};\n")
+        # The server reads exactly the size of the first message, so this one
+        # can follow straight away without waiting for a sync reply.
+        handles.write("\t// We need this message data as filler only\n")
+        handles.write("\tstruct ipc_command_msg _handle_msg = {\n")
+        handles.write("\t    .cmd = " + str(call.id) + ",\n")
+        handles.write("\t};\n")
         write_invocation(
-            f,
+            handles,
             'ret',
-            'ipc_send_handles_' + call.in_handles.stem,
+            'ipc_send_handles_' + in_handles.stem,
             (
                 '&ipc_c->imc',
                 "&_handle_msg",
                 "sizeof(_handle_msg)",
-                call.in_handles.arg_name,
-                call.in_handles.count_arg_name
+                in_handles.arg_name,
+                in_handles.count_arg_name
             ),
             indent="\t"
         )
-        f.write(';')
-        write_result_handler(f, 'ret', cleanup, indent="\t")
+        handles.write(';')
+        write_result_handler(handles, 'ret', cleanup, indent="\t")
 
-    f.write("\n\t// Await the reply")
+    receive = io.StringIO()
     func = 'ipc_receive'
     args = ['&ipc_c->imc', '&_reply', 'sizeof(_reply)']
-    if call.out_handles:
-        func += '_handles_' + call.out_handles.stem
-        args.extend(call.out_handles.arg_names)
-    write_invocation(f, 'ret', func, args, indent="\t")
-    f.write(';')
-    write_result_handler(f, 'ret', cleanup, indent="\t")
+    if out_handles:
+        func += '_handles_' + out_handles.stem
+        args.extend(out_handles.arg_names)
+    write_invocation(receive, 'ret', func, args, indent="\t")
+    receive.write(';')
+    write_result_handler(receive, 'ret', cleanup, indent="\t")
+
+    f.write(CALL_LOCKED_DEFINITION_TEMPLATE.format(
+        decl=to_str(call.write_call_locked_decl),
+        name=call.name,
+        msg_struct=to_str(write_msg_struct, call, '\t'),
+        reply_struct=to_str(write_reply_struct, call, '\t'),
+        send=send.getvalue(),
+        handles=handles.getvalue(),
+        receive=receive.getvalue(),
+        out_copy=out_args_copy_str(call)))
+
 
-    for arg in call.out_args:
-        f.write("\t*out_" + arg.name + " = _reply." + arg.name + ";\n")
-    f.write("\n\t" + cleanup)
-    f.write("\n\treturn _reply.result;\n}\n")
+def write_call_definition(f, call):
+    """Write a ipc_call_CALLNAME function, locking around the _locked one."""
+    f.write(CALL_DEFINITION_TEMPLATE.format(
+        decl=to_str(call.write_call_decl),
+        call=to_str(write_invocation, 'xrt_result_t ret',
+                    'ipc_call_' + call.name + '_locked', call.call_arg_names,
+                    "\t")))
 
 
 def generate_h(file, p):
@@ -136,14 +350,9 @@ def generate_h(file, p):
 
     Defines command enum, utility functions, and command and reply structures.
     """
-    f = open(file, "w")
-    f.write(header.format(brief='Generated IPC protocol header', suffix=''))
-    f.write('''
-#pragma once
-
-#include "xrt/xrt_compiler.h"
-
-''')
+    f = io.StringIO()
+    f.write(HEADER_PLAIN)
+    f.write(PROTOCOL_H_PREAMBLE)
 
     write_cpp_header_guard_start(f)
     f.write('''
@@ -151,12 +360,9 @@ def generate_h(file, p):
 struct ipc_connection;
 ''')
 
-    f.write('\ntypedef enum ipc_command')
-    f.write('\n{')
-    f.write('\n\tIPC_ERR = 0,')
-    for call in p.calls:
-        f.write("\n\t" + call.id + ",")
-    f.write("\n} ipc_command_t;\n")
+    f.write(COMMAND_ENUM_TEMPLATE.format(
+        entries="".join("\n\t" + call.id + "," for call in p.calls),
+        count=1 + len(p.calls)))
 
     f.write('''
 struct ipc_command_msg
@@ -173,53 +379,31 @@ struct ipc_result_reply
 
     write_decl(f, return_type='static inline const char *',
         function_name='ipc_cmd_to_str', args=['ipc_command_t id'])
-    f.write('\n{')
-    f.write('\n\tswitch (id) {')
-    f.write('\n\tcase IPC_ERR: return "IPC_ERR";')
-    for call in p.calls:
-        f.write('\n\tcase ' + call.id + ': return "' + call.id + '";')
-    f.write('\n\tdefault: return "IPC_UNKNOWN";')
-    f.write('\n\t}\n}\n')
-
-    f.write('#pragma pack (push, 1)')
-
-    for call in p.calls:
-        # Should we emit a msg struct.
-        if call.needs_msg_struct:
-            f.write('\nstruct ipc_' + call.name + '_msg\n')
-            f.write('{\n')
-            f.write('\tenum ipc_command cmd;\n')
-            for arg in call.in_args:
-                f.write('\t' + arg.get_struct_field() + ';\n')
-            if call.in_handles:
-                f.write('\t%s %s;\n' % (call.in_handles.count_arg_type,
-                                        call.in_handles.count_arg_name))
-            f.write('};\n')
-        # Should we emit a reply struct.
-        if call.out_args:
-            f.write('\nstruct ipc_' + call.name + '_reply\n')
-            f.write('{\n')
-            f.write('\txrt_result_t result;\n')
-            for arg in call.out_args:
-                f.write('\t' + arg.get_struct_field() + ';\n')
-            f.write('};\n')
-
-    f.write('#pragma pack (pop)\n')
+    f.write(CMD_TO_STR_BODY_TEMPLATE.format(
+        names="".join('\n\t    "' + call.id + '",' for call in p.calls)))
+
+    for call in p.msg_struct_calls:
+        fields = ['\t' + arg.get_struct_field() + ';\n'
+                  for arg in call.msg_struct_fields]
+        f.write(MSG_STRUCT_TEMPLATE.format(struct=call.msg_struct,
+                                           size=call.msg_size,
+                                           fields="".join(fields)))
+
+    for call in p.reply_struct_calls:
+        fields = ['\t' + arg.get_struct_field() + ';\n'
+                  for arg in call.reply_struct_fields]
+        f.write(REPLY_STRUCT_TEMPLATE.format(struct=call.reply_struct,
+                                             fields="".join(fields)))
 
     write_cpp_header_guard_end(f)
-    f.close()
+    write_output(file, f)
 
 
 def generate_client_c(file, p):
     """Generate IPC client proxy source."""
-    f = open(file, "w")
-    f.write(header.format(brief='Generated IPC client code', suffix='_client'))
-    f.write('''
-#include "client/ipc_client.h"
-#include "ipc_protocol_generated.h"
-
-
-\n''')
+    f = io.StringIO()
+    f.write(HEADER_CLIENT)
+    f.write(CLIENT_C_PREAMBLE)
 
     # Loop over all of the calls.
     for call in p.calls:
@@ -227,9 +411,10 @@ def generate_client_c(file, p):
             write_send_definition(f, call)
             write_receive_definition(f, call)
         else:
+            write_call_locked_definition(f, call)
             write_call_definition(f, call)
 
-    f.close()
+    write_output(file, f)
 
 
 def generate_client_h(file, p):
@@ -237,16 +422,9 @@ def generate_client_h(file, p):
 
     Contains prototypes for generated IPC proxy call functions.
     """
-    f = open(file, "w")
-    f.write(header.format(brief='Generated IPC client code', suffix='_client'))
-    f.write('''
-#pragma once
-
-#include "shared/ipc_protocol.h"
-#include "ipc_protocol_generated.h"
-#include "client/ipc_client.h"
-
-''')
+    f = io.StringIO()
+    f.write(HEADER_CLIENT)
+    f.write(CLIENT_H_PREAMBLE)
     write_cpp_header_guard_start(f)
     f.write("\n")
 
@@ -256,186 +434,166 @@ def generate_client_h(file, p):
             f.write(";\n")
             call.write_receive_decl(f)
         else:
+            call.write_call_locked_decl(f)
+            f.write(";\n")
             call.write_call_decl(f)
         f.write(";\n")
 
     write_cpp_header_guard_end(f)
-    f.close()
-
+    write_output(file, f)
+
+
+def write_dispatch_definition(f, call):
+    """Write a ipc_dispatch_CALLNAME function, handling one command."""
+    in_handles = call.in_handles
+    out_handles = call.out_handles
+
+    f.write(DISPATCH_DEFINITION_START.format(name=call.name))
+
+    if call.needs_msg_struct:
+        f.write("\t%s *msg = (%s *)ipc_command;\n" % (
+            call.msg_struct, call.msg_struct))
+
+    if call.varlen:
+        f.write("\t// No return arguments")
+    elif call.out_args:
+        f.write("\t%s reply = {0};\n" % call.reply_struct)
+    else:
+        f.write("\tstruct ipc_result_reply reply = {0};\n")
+
+    if in_handles:
+        in_count = "msg->" + in_handles.count_arg_name
+
+        # We need to fetch these handles separately
+        f.write("\t%s in_%s[XRT_MAX_IPC_HANDLES] = {0};\n" % (
+            in_handles.typename, in_handles.arg_name))
+        f.write("\tstruct ipc_command_msg _handle_msg = {0};\n")
+    if out_handles:
+        f.write("\t%s %s[XRT_MAX_IPC_HANDLES] = {0};\n" % (
+            out_handles.typename, out_handles.arg_name))
+        f.write("\t%s %s = {0};\n" % (
+            out_handles.count_arg_type,
+            out_handles.count_arg_name))
+    f.write("\n")
 
-def generate_server_c(file, p):
-    """Generate IPC server stub/dispatch source."""
-    f = open(file, "w")
-    f.write(header.format(brief='Generated IPC server code', suffix='_server'))
-    f.write('''
-#include "xrt/xrt_limits.h"
+    if in_handles:
+        # Validate the number of handles.
+        f.write("\tif (XRT_UNLIKELY(%s > XRT_MAX_IPC_HANDLES)) {\n" % in_count)
+        f.write("\t\treturn ipc_dispatch_bad_handle_count(%s, %s);\n" % (
+            call.id, in_count))
+        f.write("\t}\n")
 
-#include "shared/ipc_protocol.h"
-#include "shared/ipc_utils.h"
+        # The client sends the handles right after the msg.
+        write_invocation(
+            f,
+            'xrt_result_t receive_handle_result',
+            'ipc_receive_handles_' + in_handles.stem,
+            (
+                "(struct ipc_message_channel *)&ics->imc",
+                "&_handle_msg",
+                "sizeof(_handle_msg)",
+                "in_" + in_handles.arg_name,
+                in_count
+            ),
+            indent="\t"
+        )
+        f.write(";")
+        write_result_handler(f, "receive_handle_result",
+                             indent="\t")
+        f.write("\tif (XRT_UNLIKELY(_handle_msg.cmd != %s)) {\n" % str(call.id))
+        f.write("\t\treturn XRT_ERROR_IPC_FAILURE;\n")
+        f.write("\t}\n")
 
-#include "server/ipc_server.h"
+    # Write call to ipc_handle_CALLNAME
+    args = ["ics"]
 
-#include "ipc_server_generated.h"
+    # Always provide in arguments.
+    for arg in call.in_args:
+        args.append(("&msg->" + arg.name)
+                    if arg.is_aggregate
+                    else ("msg->" + arg.name))
 
-''')
+    # No reply arguments on varlen.
+    if not call.varlen:
+        args.extend("&reply." + arg.name for arg in call.out_args)
 
-    f.write('''
-xrt_result_t
-ipc_dispatch(volatile struct ipc_client_state *ics, ipc_command_t *ipc_command)
-{
-\tswitch (*ipc_command) {
-''')
+    if out_handles:
+        args.extend(("XRT_MAX_IPC_HANDLES",
+                     out_handles.arg_name,
+                     "&" + out_handles.count_arg_name))
 
-    for call in p.calls:
-        f.write("\tcase " + call.id + ": {\n")
+    if in_handles:
+        args.extend(("&in_%s[0]" % in_handles.arg_name, in_count))
 
-        f.write("\t\tIPC_TRACE(ics->server, \"Dispatching " + call.name +
-                "\");\n\n")
+    # Should we put the return in the reply or return it?
+    return_target = 'reply.result'
+    if call.varlen:
+        return_target = 'xrt_result_t xret'
 
-        if call.needs_msg_struct:
-            f.write(
-                "\t\tstruct ipc_{}_msg *msg = ".format(call.name))
-            f.write("(struct ipc_{}_msg *)ipc_command;\n".format(call.name))
+    write_invocation(f, return_target, 'ipc_handle_' +
+                     call.name, args, indent="\t")
+    f.write(";\n")
 
-        if call.varlen:
-            f.write("\t\t// No return arguments")
-        elif call.out_args:
-            f.write("\t\tstruct ipc_%s_reply reply = {0};\n" % call.name)
-        else:
-            f.write("\t\tstruct ipc_result_reply reply = {0};\n")
-
-        if call.in_handles:
-            # We need to fetch these handles separately
-            f.write("\t\tstruct ipc_result_reply _sync = {XRT_SUCCESS};\n")
-            f.write("\t\t%s in_%s[XRT_MAX_IPC_HANDLES] = {0};\n" % (
-                call.in_handles.typename, call.in_handles.arg_name))
-            f.write("\t\tstruct ipc_command_msg _handle_msg = {0};\n")
-        if call.out_handles:
-            f.write("\t\t%s %s[XRT_MAX_IPC_HANDLES] = {0};\n" % (
-                call.out_handles.typename, call.out_handles.arg_name))
-            f.write("\t\t%s %s = {0};\n" % (
-                call.out_handles.count_arg_type,
-                call.out_handles.count_arg_name))
-        f.write("\n")
-
-        if call.in_handles:
-            # Validate the number of handles.
-            f.write("\t\tif (msg->%s > XRT_MAX_IPC_HANDLES) {\n" % (call.in_handles.count_arg_name))
-            f.write("\t\t\treturn XRT_ERROR_IPC_FAILURE;\n")
-            f.write("\t\t}\n")
-
-            # Let the client know we are ready to receive the handles.
-            write_invocation(
-                f,
-                'xrt_result_t sync_result',
-                'ipc_send',
-                (
-                    "(struct ipc_message_channel *)&ics->imc",
-                    "&_sync",
-                    "sizeof(_sync)"
-                ),
-                indent="\t\t"
-            )
-            f.write(";")
-            write_result_handler(f, "sync_result",
-                                 indent="\t\t")
-            write_invocation(
-                f,
-                'xrt_result_t receive_handle_result',
-                'ipc_receive_handles_' + call.in_handles.stem,
-                (
-                    "(struct ipc_message_channel *)&ics->imc",
-                    "&_handle_msg",
-                    "sizeof(_handle_msg)",
-                    "in_" + call.in_handles.arg_name,
-                    "msg->"+call.in_handles.count_arg_name
-                ),
-                indent="\t\t"
-            )
-            f.write(";")
-            write_result_handler(f, "receive_handle_result",
-                                 indent="\t\t")
-            f.write("\t\tif (_handle_msg.cmd != %s) {\n" % str(call.id))
-            f.write("\t\t\treturn XRT_ERROR_IPC_FAILURE;\n")
-            f.write("\t\t}\n")
-
-        # Write call to ipc_handle_CALLNAME
-        args = ["ics"]
-
-        # Always provide in arguments.
-        for arg in call.in_args:
-            args.append(("&msg->" + arg.name)
-                        if arg.is_aggregate
-                        else ("msg->" + arg.name))
-
-        # No reply arguments on varlen.
-        if not call.varlen:
-            args.extend("&reply." + arg.name for arg in call.out_args)
-
-        if call.out_handles:
-            args.extend(("XRT_MAX_IPC_HANDLES",
-                         call.out_handles.arg_name,
-                         "&" + call.out_handles.count_arg_name))
-
-        if call.in_handles:
-            args.extend(("&in_%s[0]" % call.in_handles.arg_name,
-                         "msg->"+call.in_handles.count_arg_name))
-
-        # Should we put the return in the reply or return it?
-        return_target = 'reply.result'
-        if call.varlen:
-            return_target = 'xrt_result_t xret'
+    # TODO do we check reply.result and
+    # error out before replying if it's not success?
 
-        write_invocation(f, return_target, 'ipc_handle_' +
-                         call.name, args, indent="\t\t")
-        f.write(";\n")
+    if not call.varlen:
+        func = 'ipc_send'
+        args = ["(struct ipc_message_channel *)&ics->imc",
+                "&reply",
+                "sizeof(reply)"]
+        if out_handles:
+            func += '_handles_' + out_handles.stem
+            args.extend(out_handles.arg_names)
+        write_invocation(f, 'xrt_result_t xret', func, args, indent="\t")
+        f.write(";")
 
-        # TODO do we check reply.result and
-        # error out before replying if it's not success?
-
-        if not call.varlen:
-            func = 'ipc_send'
-            args = ["(struct ipc_message_channel *)&ics->imc",
-                    "&reply",
-                    "sizeof(reply)"]
-            if call.out_handles:
-                func += '_handles_' + call.out_handles.stem
-                args.extend(call.out_handles.arg_names)
-            write_invocation(f, 'xrt_result_t xret', func, args, indent="\t\t")
-            f.write(";")
-
-        f.write("\n\t\treturn xret;\n")
-        f.write("\t}\n")
-    f.write('''\tdefault:
-\t\tU_LOG_E("UNHANDLED IPC MESSAGE! %d", *ipc_command);
-\t\treturn XRT_ERROR_IPC_FAILURE;
-\t}
-}
+    f.write("\n\treturn xret;\n}\n")
 
-''')
 
-    f.write('''
-size_t
-ipc_command_size(const enum ipc_command cmd)
-{
-\tswitch (cmd) {
-''')
+def generate_server_c(file, p):
+    """Generate IPC server stub/dispatch source."""
+    f = io.StringIO()
+    f.write(HEADER_SERVER)
+    f.write(SERVER_C_PREAMBLE)
+    f.write(DISPATCH_COLD_HELPERS)
 
+    for call in p.calls:
+        write_dispatch_definition(f, call)
+
+    f.write(DISPATCH_TEMPLATE.format(
+        entries="".join("\t[" + call.id + "] = ipc_dispatch_" + call.name +
+                        ",\n" for call in p.calls)))
+
+    asserts = []
+    for call in p.msg_struct_calls:
+        asserts.append("static_assert(sizeof(" + call.msg_struct + ") <= "
+                       "IPC_BUF_SIZE, \"Message too large\");\n")
+
+    layouts = [(call.msg_struct, call.msg_struct_fields)
+               for call in p.msg_struct_calls]
+    layouts += [(call.reply_struct, call.reply_struct_fields)
+                for call in p.reply_struct_calls]
+
+    offsets = []
+    for struct, fields in layouts:
+        for arg, offset in known_field_offsets(fields):
+            offsets.append("static_assert(offsetof(" + struct + ", " +
+                           arg.name + ") == " + str(offset) +
+                           ", \"Wire layout changed\");\n")
+
+    sizes = []
     for call in p.calls:
         if call.needs_msg_struct:
-            f.write("\tcase " + call.id + ": return sizeof(struct ipc_{}_msg);\n".format(call.name))
+            size = call.msg_size
         else:
-            f.write("\tcase " + call.id + ": return sizeof(enum ipc_command);\n")
+            size = "sizeof(enum ipc_command)"
+        sizes.append("\t[" + call.id + "] = " + size + ",\n")
+    f.write(COMMAND_SIZE_TEMPLATE.format(asserts="".join(asserts),
+                                         offsets="".join(offsets),
+                                         sizes="".join(sizes)))
 
-    f.write('''\tdefault:
-\t\tU_LOG_E("UNHANDLED IPC COMMAND! %d", cmd);
-\t\treturn 0;
-\t}
-}
-
-''')
-
-    f.close()
+    write_output(file, f)
 
 
 def generate_server_header(file, p):
@@ -444,17 +602,9 @@ def generate_server_header(file, p):
     Declares handler prototypes to implement,
     as well as the prototype for the generated dispatch function.
     """
-    f = open(file, "w")
-    f.write(header.format(brief='Generated IPC server code', suffix='_server'))
-    f.write('''
-#pragma once
-
-#include "shared/ipc_protocol.h"
-#include "ipc_protocol_generated.h"
-#include "server/ipc_server.h"
-
-
-''')
+    f = io.StringIO()
+    f.write(HEADER_SERVER)
+    f.write(SERVER_H_PREAMBLE)
 
     write_cpp_header_guard_start(f)
     f.write("\n")
@@ -487,11 +637,37 @@ def generate_server_header(file, p):
         f.write(";\n")
 
     write_cpp_header_guard_end(f)
-    f.close()
+    write_output(file, f)
+
+
+GENERATORS = (
+    ("ipc_protocol_generated.h", generate_h),
+    ("ipc_client_generated.c", generate_client_c),
+    ("ipc_client_generated.h", generate_client_h),
+    ("ipc_server_generated.c", generate_server_c),
+    ("ipc_server_generated.h", generate_server_header),
+)
+
+
+def generate_output(output, p):
+    """Generate a single file, uses the name to choose output type."""
+    for suffix, generate in GENERATORS:
+        if output.endswith(suffix):
+            generate(output, p)
+
+
+def generate(proto_path, outputs):
+    """Parse the protocol file once and generate all of the given outputs."""
+    p = Proto.load_and_parse(proto_path)
+
+    for output in outputs:
+        generate_output(output, p)
 
 
 def main():
     """Handle command line and generate a file."""
+    import argparse
+
     parser = argparse.ArgumentParser(description='Protocol generator.')
     parser.add_argument(
         'proto', help='Protocol file to use')
@@ -500,19 +676,7 @@ def main():
         help='Output file, uses the name to choose output type')
     args = parser.parse_args()
 
-    p = Proto.load_and_parse(args.proto)
-
-    for output in args.output:
-        if output.endswith("ipc_protocol_generated.h"):
-            generate_h(output, p)
-        if output.endswith("ipc_client_generated.c"):
-            generate_client_c(output, p)
-        if output.endswith("ipc_client_generated.h"):
-            generate_client_h(output, p)
-        if output.endswith("ipc_server_generated.c"):
-            generate_server_c(output, p)
-        if output.endswith("ipc_server_generated.h"):
-            generate_server_header(output, p)
+    generate(args.proto, args.output)
 
 
 if __name__ == "__main__":